@@ -1,31 +1,89 @@
 import argparse
+import json
+import math
 import os
+import shutil
+from typing import BinaryIO, Iterable, Iterator
 
 import numpy as np
 
+# Upper bound on the fan-out of a single shuffle scatter.
+MAX_SHUFFLE_BUCKETS = 256
 
-def main(
-    simulations_path: str,
+
+def changed_cells(a: np.ndarray, b: np.ndarray) -> int:
+    """Number of cells whose colour differs between frames `a` and `b`."""
+    return int(np.count_nonzero((a != b).any(axis=-1)))
+
+
+def simulation_windows(
+    simulation_path: str,
     simulation_frames: int,
     simulation_height: int,
     simulation_width: int,
     frames_per_row: int,
+    min_changed_cells: int,
+    idle_keep_every: int,
+    stats: dict,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Yield a simulation's (frames, actions) windows that pass the activity filter."""
+    frames = np.memmap(
+        dtype=np.uint8,
+        shape=(
+            simulation_frames,
+            simulation_height,
+            simulation_width,
+            3,
+        ),
+        mode="r",
+        filename=os.path.join(simulation_path, "frames.npy"),
+    )
+    actions = np.memmap(
+        dtype=np.uint8,
+        shape=(simulation_frames, 4),
+        mode="r",
+        filename=os.path.join(simulation_path, "actions.npy"),
+    )
+    # Number of cells that changed between frame i - 1 and frame i.
+    # Filled in as frames enter the window, so each frame is only compared once.
+    changes = np.zeros(simulation_frames, dtype=np.int64)
+    for j in range(1, frames_per_row - 1):
+        changes[j] = changed_cells(frames[j - 1], frames[j])
+    n_idle = 0
+    sim_stats = {"kept": 0, "dropped": 0}
+    stats["simulations"][os.path.basename(simulation_path)] = sim_stats
+    # Run a sliding window over the frames and actions.
+    for i in range(simulation_frames - frames_per_row):
+        last = i + frames_per_row - 1
+        if last > 0:
+            changes[last] = changed_cells(frames[last - 1], frames[last])
+        stats["total_windows"] += 1
+        # Element 0 is 'nothing', so any non-zero element means a stroke was drawn.
+        has_action = bool(actions[i : i + frames_per_row, 3].any())
+        window_changes = int(changes[i + 1 : last + 1].sum())
+        if has_action or window_changes >= min_changed_cells:
+            stats["kept_active"] += 1
+        else:
+            n_idle += 1
+            # Keep every `idle_keep_every`th idle window, or none if it is 0.
+            if idle_keep_every <= 0 or (n_idle - 1) % idle_keep_every:
+                stats["dropped_idle"] += 1
+                sim_stats["dropped"] += 1
+                continue
+            stats["kept_idle"] += 1
+        sim_stats["kept"] += 1
+        yield frames[i : i + frames_per_row], actions[i : i + frames_per_row]
+
+
+def write_sequential(
+    windows: Iterator[tuple[np.ndarray, np.ndarray]],
+    n_rows: int,
+    frames_per_row: int,
+    simulation_height: int,
+    simulation_width: int,
     output_path: str,
-):
-    os.makedirs(output_path, exist_ok=True)
-    simulations = [
-        dir
-        for dir in os.listdir(simulations_path)
-        if os.path.isdir(dir)
-        and len(
-            {"frames.npy", "actions.npy"}.intersection(
-                set(os.listdir(os.path.join(simulations_path, dir)))
-            )
-        )
-        == 2
-    ]
-    # We slide the window along the frames until the end of the window reaches the last frame.
-    n_rows = len(simulations) * (simulation_frames - frames_per_row)
+) -> int:
+    """Write windows in the order they are produced. Returns the number of rows."""
     all_frames = np.memmap(
         dtype=np.uint8,
         shape=(n_rows, frames_per_row, simulation_height, simulation_width, 3),
@@ -39,32 +97,258 @@ def main(
         filename=f"{output_path}/actions.npy",
     )
     current_row = 0
-    for simulation in simulations:
-        simulation_path = os.path.join(simulations_path, simulation)
-        assert os.path.isdir(simulation_path)
-        frames = np.memmap(
-            dtype=np.uint8,
-            shape=(
+    for frames, actions in windows:
+        all_frames[current_row] = frames
+        all_actions[current_row] = actions
+        current_row += 1
+
+    # Drop the unused tail of the preallocated output files.
+    all_frames.flush()
+    all_actions.flush()
+    frames_row_bytes = all_frames[0].nbytes if n_rows else 0
+    actions_row_bytes = all_actions[0].nbytes if n_rows else 0
+    del all_frames, all_actions
+    os.truncate(f"{output_path}/frames.npy", current_row * frames_row_bytes)
+    os.truncate(f"{output_path}/actions.npy", current_row * actions_row_bytes)
+    return current_row
+
+
+def write_records(
+    records: np.ndarray, frames_out: BinaryIO, actions_out: BinaryIO, rows: int = 8
+):
+    """Append `records` to the frames and actions outputs a few rows at a time."""
+    for start in range(0, len(records), rows):
+        block = records[start : start + rows]
+        np.ascontiguousarray(block["frames"]).tofile(frames_out)
+        np.ascontiguousarray(block["actions"]).tofile(actions_out)
+
+
+def scatter(
+    chunks: Iterable[np.ndarray],
+    n_buckets: int,
+    bucket_path: str,
+    prefix: str,
+    rng: np.random.Generator,
+) -> list[str]:
+    """Append each record in `chunks` to a uniformly random bucket file.
+
+    Bucket files are opened one at a time, so the number of buckets is not limited
+    by the open file descriptor limit.
+    """
+    paths = [os.path.join(bucket_path, f"{prefix}{b}.npy") for b in range(n_buckets)]
+    for path in paths:
+        open(path, "wb").close()
+    for chunk in chunks:
+        buckets = rng.integers(n_buckets, size=len(chunk))
+        for b, path in enumerate(paths):
+            rows = chunk[buckets == b]
+            if len(rows):
+                with open(path, "ab") as f:
+                    rows.tofile(f)
+    return paths
+
+
+def shuffle_bucket(
+    path: str,
+    record: np.dtype,
+    memory_bytes: int,
+    frames_out: BinaryIO,
+    actions_out: BinaryIO,
+    rng: np.random.Generator,
+) -> int:
+    """Shuffle a bucket file into the outputs, then delete it. Returns its rows.
+
+    Buckets that fit in `memory_bytes` are shuffled in place in memory; larger ones
+    are scattered into sub-buckets first.
+    """
+    size = os.path.getsize(path)
+    n_rows = size // record.itemsize
+    if size <= memory_bytes or n_rows <= 1:
+        records = np.fromfile(path, dtype=record)
+        rng.shuffle(records)
+        write_records(records, frames_out, actions_out)
+    else:
+        source = np.memmap(path, dtype=record, mode="r")
+        chunk_rows = max(1, memory_bytes // record.itemsize)
+        paths = scatter(
+            (source[i : i + chunk_rows] for i in range(0, n_rows, chunk_rows)),
+            min(MAX_SHUFFLE_BUCKETS, math.ceil(2 * size / memory_bytes)),
+            os.path.dirname(path),
+            f"{os.path.splitext(os.path.basename(path))[0]}_",
+            rng,
+        )
+        del source
+        for sub_path in paths:
+            shuffle_bucket(sub_path, record, memory_bytes, frames_out, actions_out, rng)
+    os.remove(path)
+    return n_rows
+
+
+def write_shuffled(
+    windows: Iterator[tuple[np.ndarray, np.ndarray]],
+    max_rows: int,
+    memory_bytes: int,
+    frames_per_row: int,
+    simulation_height: int,
+    simulation_width: int,
+    output_path: str,
+    rng: np.random.Generator,
+) -> int:
+    """Write windows in a random order using a bounded-memory external shuffle.
+
+    Windows are buffered in chunks of up to `memory_bytes` and scattered to random
+    bucket files, then each bucket is shuffled in memory and appended to the output.
+    Buckets that turn out larger than `memory_bytes` are scattered again, so peak
+    memory stays around `memory_bytes`. Returns the number of rows.
+    """
+    frame_shape = (frames_per_row, simulation_height, simulation_width, 3)
+    record = np.dtype(
+        [("frames", np.uint8, frame_shape), ("actions", np.uint8, (frames_per_row, 4))]
+    )
+    chunk_rows = max(1, memory_bytes // record.itemsize)
+
+    def chunks() -> Iterator[np.ndarray]:
+        chunk = np.empty(chunk_rows, dtype=record)
+        n = 0
+        for frames, actions in windows:
+            chunk["frames"][n] = frames
+            chunk["actions"][n] = actions
+            n += 1
+            if n == chunk_rows:
+                yield chunk
+                n = 0
+        if n:
+            yield chunk[:n]
+
+    # `max_rows` ignores idle filtering, so this may overestimate; aim for buckets
+    # of about half the budget so few need a second scatter.
+    n_buckets = min(
+        MAX_SHUFFLE_BUCKETS,
+        max(1, math.ceil(2 * max_rows * record.itemsize / memory_bytes)),
+    )
+    bucket_path = os.path.join(output_path, "buckets")
+    os.makedirs(bucket_path, exist_ok=True)
+    n_rows = 0
+    try:
+        paths = scatter(chunks(), n_buckets, bucket_path, "", rng)
+        with open(f"{output_path}/frames.npy", "wb") as frames_out, open(
+            f"{output_path}/actions.npy", "wb"
+        ) as actions_out:
+            for path in paths:
+                n_rows += shuffle_bucket(
+                    path, record, memory_bytes, frames_out, actions_out, rng
+                )
+    finally:
+        shutil.rmtree(bucket_path, ignore_errors=True)
+    return n_rows
+
+
+def main(
+    simulations_path: str,
+    simulation_frames: int,
+    simulation_height: int,
+    simulation_width: int,
+    frames_per_row: int,
+    output_path: str,
+    min_changed_cells: int = 0,
+    idle_keep_every: int = 0,
+    shuffle: bool = False,
+    val_fraction: float = 0.1,
+    shuffle_memory_mb: int = 1024,
+    seed: int = 0,
+):
+    if shuffle_memory_mb <= 0:
+        raise ValueError(f"shuffle_memory_mb must be positive, got {shuffle_memory_mb}")
+    if not 0 <= val_fraction <= 1:
+        raise ValueError(f"val_fraction must be in [0, 1], got {val_fraction}")
+    os.makedirs(output_path, exist_ok=True)
+    simulations = sorted(
+        dir
+        for dir in os.listdir(simulations_path)
+        if os.path.isdir(os.path.join(simulations_path, dir))
+        and len(
+            {"frames.npy", "actions.npy"}.intersection(
+                set(os.listdir(os.path.join(simulations_path, dir)))
+            )
+        )
+        == 2
+    )
+    rng = np.random.default_rng(seed)
+    if shuffle:
+        # Split by simulation so no val window shares frames with a train window.
+        simulations = [simulations[i] for i in rng.permutation(len(simulations))]
+        n_val = round(len(simulations) * val_fraction)
+        splits = {"train": simulations[n_val:], "val": simulations[:n_val]}
+    else:
+        splits = {"": simulations}
+
+    stats = {
+        "total_windows": 0,
+        "kept_active": 0,
+        "kept_idle": 0,
+        "dropped_idle": 0,
+        "simulations": {},
+        "splits": {},
+    }
+    windows_per_sim = simulation_frames - frames_per_row
+    for split, split_simulations in splits.items():
+        split_path = os.path.join(output_path, split)
+        os.makedirs(split_path, exist_ok=True)
+        windows = (
+            window
+            for simulation in split_simulations
+            for window in simulation_windows(
+                os.path.join(simulations_path, simulation),
                 simulation_frames,
                 simulation_height,
                 simulation_width,
-                3,
-            ),
-            mode="r",
-            filename=os.path.join(simulation_path, "frames.npy"),
-        )
-        actions = np.memmap(
-            dtype=np.uint8,
-            shape=(simulation_frames, 4),
-            mode="r",
-            filename=os.path.join(simulation_path, "actions.npy"),
+                frames_per_row,
+                min_changed_cells,
+                idle_keep_every,
+                stats,
+            )
         )
-        # Run a sliding window over the frames and actions.
-        # Collect add each window to the output dataset.
-        for i in range(simulation_frames - frames_per_row):
-            all_frames[current_row] = frames[i : i + frames_per_row]
-            all_actions[current_row] = actions[i : i + frames_per_row]
-            current_row += 1
+        # We slide the window along the frames until the end of the window reaches
+        # the last frame. This is an upper bound; idle windows may be dropped.
+        max_rows = len(split_simulations) * windows_per_sim
+        if shuffle:
+            n_rows = write_shuffled(
+                windows,
+                max_rows,
+                shuffle_memory_mb * 2**20,
+                frames_per_row,
+                simulation_height,
+                simulation_width,
+                split_path,
+                rng,
+            )
+        else:
+            n_rows = write_sequential(
+                windows,
+                max_rows,
+                frames_per_row,
+                simulation_height,
+                simulation_width,
+                split_path,
+            )
+        stats["splits"][split or "all"] = {
+            "n_rows": n_rows,
+            "simulations": split_simulations,
+        }
+
+    stats["n_rows"] = sum(split["n_rows"] for split in stats["splits"].values())
+    stats["frames_per_row"] = frames_per_row
+    stats["min_changed_cells"] = min_changed_cells
+    stats["idle_keep_every"] = idle_keep_every
+    stats["shuffle"] = shuffle
+    stats["seed"] = seed
+    with open(f"{output_path}/stats.json", "w") as f:
+        json.dump(stats, f, indent=2)
+    print(
+        f"Kept {stats['n_rows']}/{stats['total_windows']} windows "
+        f"({stats['kept_active']} active, {stats['kept_idle']} idle, "
+        f"{stats['dropped_idle']} idle dropped)."
+    )
 
 
 if __name__ == "__main__":
@@ -105,5 +389,45 @@ if __name__ == "__main__":
         default="dataset",
         help="Path to output dataset",
     )
+    parser.add_argument(
+        "--min-changed-cells",
+        type=int,
+        default=0,
+        help="Windows without an action and with fewer changed cells are idle",
+    )
+    parser.add_argument(
+        "--idle-keep-every",
+        type=int,
+        default=0,
+        help="Keep every nth idle window (0 drops all idle windows)",
+    )
+    parser.add_argument(
+        "--shuffle",
+        action="store_true",
+        help="Write pre-shuffled train/ and val/ datasets split by simulation",
+    )
+    parser.add_argument(
+        "--val-fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of simulations used for validation when shuffling",
+    )
+    parser.add_argument(
+        "--shuffle-memory-mb",
+        type=int,
+        default=1024,
+        help="Approximate peak memory of the shuffle, used both for the scatter "
+        "buffer and as the largest bucket shuffled in memory",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the train/val split and shuffle",
+    )
     args = parser.parse_args()
+    if args.shuffle_memory_mb <= 0:
+        parser.error("--shuffle-memory-mb must be positive")
+    if not 0 <= args.val_fraction <= 1:
+        parser.error("--val-fraction must be between 0 and 1")
     main(**vars(args))
@@ -1,16 +1,24 @@
+from __future__ import annotations
+
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from typing import Any
+from typing import TYPE_CHECKING, Any
 import argparse
+import math
+import multiprocessing
 import random
 import os
-from multiprocessing import Pool
+import threading
 
-import pygame
 import sys
 import numpy as np
-from elements import COLOURS, ELEMENTS, Particle, Metal, Water, Sand, Acid
-from utils import bezier
+from .elements import COLOURS, ELEMENTS, Particle, Metal, Water, Sand, Acid
+from .utils import bezier
+
+if TYPE_CHECKING:
+    # pygame is imported lazily by the classes that need it so that headless
+    # simulation workers never load SDL.
+    import pygame
 
 
 @dataclass
@@ -42,6 +50,7 @@ class PenStroke:
 class SimulationConfig(Config):
     data_path: str
     n_strokes: int
+    prefetch_frames: int = 64
 
 
 class Renderer(ABC):
@@ -58,6 +67,8 @@ class Renderer(ABC):
 
 class PygameRenderer(Renderer):
     def __init__(self, config: Config):
+        import pygame
+
         self.window = pygame.display.set_mode((config.width, config.height))
         pygame.display.set_caption("Falling Sand")
         self.config = config
@@ -66,10 +77,14 @@ class PygameRenderer(Renderer):
         self.scale = config.scale
 
     def setup(self, config: Config):
+        import pygame
+
         pygame.init()
         return pygame.time.Clock()
 
     def draw(self, state: dict[tuple[int, int], Particle]):
+        import pygame
+
         self.surface.fill(self.aircolor)
         for element in state.values():
             self.surface.fill(
@@ -87,6 +102,8 @@ class PygameRenderer(Renderer):
 
 class ReplayRenderer(Renderer):
     def __init__(self, config: SimulationConfig):
+        import pygame
+
         self.window = pygame.display.set_mode((config.width, config.height))
         pygame.display.set_caption("Falling Sand Replay")
 
@@ -105,10 +122,14 @@ class ReplayRenderer(Renderer):
         self.config = config
 
     def setup(self, config: Config):
+        import pygame
+
         pygame.init()
         return pygame.time.Clock()
 
     def draw(self, state: dict[tuple[int, int], Particle]):
+        import pygame
+
         if self.frame_idx >= len(self.frames):
             pygame.quit()
             sys.exit()
@@ -120,6 +141,232 @@ class ReplayRenderer(Renderer):
         self.frame_idx += 1
 
 
+# Playback speed limits of the mosaic replay, in frames per draw.
+MIN_REPLAY_SPEED = 1 / 8
+MAX_REPLAY_SPEED = 64
+
+
+class MosaicReplayRenderer(Renderer):
+    """Replay many recorded simulations at once, tiled into a single window.
+
+    `data_path` is a directory of `sim_<index>` recordings, as written by multi-sim
+    runs; the first `num_sims` of them by index are tiled. The frame count comes
+    from the recordings themselves, so `max_frames` is ignored. Upcoming mosaic
+    frames are decoded by a background thread into a ring buffer so playback stays
+    smooth when the recordings live on slow disk.
+
+    Controls: space play/pause, left/right step, up/down double/halve speed,
+    r reverse, home/end jump to start/end, page up/down skip 100 frames, and
+    click or drag anywhere in the window to scrub.
+    """
+
+    def __init__(self, config: SimulationConfig):
+        import pygame
+
+        self.window = pygame.display.set_mode((config.width, config.height))
+        pygame.display.set_caption("Falling Sand Mosaic Replay")
+        self.config = config
+
+        # Tile in sim index order, so sim_2 comes before sim_10.
+        sim_dirs = sorted(
+            (
+                dir
+                for dir in os.listdir(config.data_path)
+                if dir.startswith("sim_")
+                and dir[len("sim_") :].isdigit()
+                and os.path.isfile(os.path.join(config.data_path, dir, "frames.npy"))
+            ),
+            key=lambda dir: int(dir[len("sim_") :]),
+        )
+        sim_paths = [
+            os.path.join(config.data_path, dir)
+            for dir in sim_dirs[: max(config.num_sims, 1)]
+        ]
+        assert sim_paths, f"No recorded simulations found in {config.data_path}"
+        # Recordings are raw uint8 memmaps, so the frame count follows from the size.
+        frame_bytes = config.height * config.width * 3
+        self.n_frames = min(
+            os.path.getsize(os.path.join(path, "frames.npy")) // frame_bytes
+            for path in sim_paths
+        )
+        self.sims = [
+            np.memmap(
+                dtype=np.uint8,
+                shape=(self.n_frames, config.height, config.width, 3),
+                mode="r",
+                filename=os.path.join(path, "frames.npy"),
+            )
+            for path in sim_paths
+        ]
+
+        cols = math.ceil(math.sqrt(len(self.sims)))
+        rows = math.ceil(len(self.sims) / cols)
+        self.tile_width = config.width // cols
+        self.tile_height = config.height // rows
+        self.stride = max(
+            math.ceil(config.width / self.tile_width),
+            math.ceil(config.height / self.tile_height),
+        )
+        self.origins = [
+            ((i % cols) * self.tile_width, (i // cols) * self.tile_height)
+            for i in range(len(self.sims))
+        ]
+
+        # Mosaics are stored (width, height, 3) to match pygame's surfarray layout.
+        self.ring_size = max(config.prefetch_frames, 1)
+        self.ring = np.zeros(
+            (self.ring_size, config.width, config.height, 3), dtype=np.uint8
+        )
+        self.slots = np.full(self.ring_size, -1, dtype=np.int64)
+        self.scratch = np.zeros_like(self.ring[0])
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.position = 0.0
+        self.speed = 1.0
+        self.paused = False
+        self.scrubbing = False
+        self.prefetcher = threading.Thread(target=self.prefetch, daemon=True)
+
+    def setup(self, config: Config):
+        import pygame
+
+        pygame.init()
+        self.surface = pygame.Surface((config.width, config.height))
+        self.prefetcher.start()
+        return pygame.time.Clock()
+
+    def decode(self, frame_idx: int, out: np.ndarray):
+        """Tile frame `frame_idx` of every simulation into `out`."""
+        s = self.stride
+        for (x, y), frames in zip(self.origins, self.sims):
+            tile = frames[frame_idx, ::s, ::s].transpose(1, 0, 2)
+            tile = tile[: self.tile_width, : self.tile_height]
+            out[x : x + tile.shape[0], y : y + tile.shape[1]] = tile
+
+    def step(self) -> int:
+        """Frames between consecutively displayed frames at the current speed."""
+        return max(1, round(abs(self.speed)))
+
+    def slot(self, frame_idx: int) -> int:
+        # Frames `step` apart map to consecutive slots, so a full lookahead
+        # never evicts itself.
+        return (frame_idx // self.step()) % self.ring_size
+
+    def in_window(self, frame_idx: int) -> bool:
+        """Whether `frame_idx` is one of the frames playback will show next."""
+        direction = -1 if self.speed < 0 else 1
+        offset = (frame_idx - int(self.position)) * direction
+        step = self.step()
+        return 0 <= offset < self.ring_size * step and offset % step == 0
+
+    def prefetch(self):
+        scratch = np.zeros_like(self.ring[0])
+        while True:
+            self.wake.clear()
+            with self.lock:
+                start = int(self.position)
+                speed = self.speed
+                direction = -1 if speed < 0 else 1
+                step = self.step()
+            for offset in range(self.ring_size):
+                # Only decode the frames playback will actually land on.
+                frame_idx = start + offset * step * direction
+                if not 0 <= frame_idx < self.n_frames:
+                    break
+                with self.lock:
+                    if int(self.position) != start or self.speed != speed:
+                        # Seeked, moved on or changed speed; restart from there.
+                        break
+                    if self.slots[self.slot(frame_idx)] == frame_idx:
+                        continue
+                self.decode(frame_idx, scratch)
+                with self.lock:
+                    if self.in_window(frame_idx):
+                        self.ring[self.slot(frame_idx)] = scratch
+                        self.slots[self.slot(frame_idx)] = frame_idx
+            self.wake.wait()
+
+    def seek(self, frame_idx: float):
+        with self.lock:
+            self.position = float(min(max(frame_idx, 0), self.n_frames - 1))
+        self.wake.set()
+
+    def handle_events(self):
+        import pygame
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit()
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                self.scrubbing = True
+            if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                self.scrubbing = False
+            if self.scrubbing and event.type in (
+                pygame.MOUSEBUTTONDOWN,
+                pygame.MOUSEMOTION,
+            ):
+                self.seek(event.pos[0] / self.config.width * (self.n_frames - 1))
+            if event.type != pygame.KEYDOWN:
+                continue
+            if event.key == pygame.K_SPACE:
+                self.paused = not self.paused
+            elif event.key in (pygame.K_LEFT, pygame.K_RIGHT):
+                self.paused = True
+                step = 1 if event.key == pygame.K_RIGHT else -1
+                self.seek(int(self.position) + step)
+            elif event.key in (pygame.K_UP, pygame.K_DOWN):
+                with self.lock:
+                    speed = abs(self.speed) * (2 if event.key == pygame.K_UP else 0.5)
+                    speed = min(max(speed, MIN_REPLAY_SPEED), MAX_REPLAY_SPEED)
+                    self.speed = speed if self.speed > 0 else -speed
+                self.wake.set()
+            elif event.key == pygame.K_r:
+                with self.lock:
+                    self.speed = -self.speed
+                self.wake.set()
+            elif event.key == pygame.K_HOME:
+                self.seek(0)
+            elif event.key == pygame.K_END:
+                self.seek(self.n_frames - 1)
+            elif event.key in (pygame.K_PAGEUP, pygame.K_PAGEDOWN):
+                skip = 100 if event.key == pygame.K_PAGEDOWN else -100
+                self.seek(self.position + skip)
+
+    def draw(self, state: dict[tuple[int, int], Particle]):
+        import pygame
+
+        self.handle_events()
+        frame_idx = int(self.position)
+        with self.lock:
+            slot = self.slot(frame_idx)
+            hit = self.slots[slot] == frame_idx
+            if hit:
+                pygame.surfarray.blit_array(self.surface, self.ring[slot])
+        if not hit:
+            # Prefetch miss (e.g. just after a seek); decode this frame directly.
+            self.decode(frame_idx, self.scratch)
+            pygame.surfarray.blit_array(self.surface, self.scratch)
+        self.window.blit(self.surface, (0, 0))
+        progress = frame_idx / max(self.n_frames - 1, 1)
+        pygame.draw.rect(
+            self.window,
+            (255, 255, 255),
+            pygame.Rect(
+                0, self.config.height - 3, int(progress * self.config.width), 3
+            ),
+        )
+        pygame.display.flip()
+
+        if self.paused or self.scrubbing:
+            return
+        position = self.position + self.speed
+        if not 0 <= position <= self.n_frames - 1:
+            # Hold on the first/last frame rather than exiting.
+            self.paused = True
+        self.seek(position)
+
+
 class SimulationRenderer(Renderer):
     def __init__(self, config: SimulationConfig):
         os.makedirs(config.data_path, exist_ok=True)
@@ -193,6 +440,8 @@ class PygameInputHandler(InputHandler):
         pass
 
     def update(self, state: dict[tuple[int, int], Particle]):
+        import pygame
+
         for event in pygame.event.get():  # detect events
             if event.type == pygame.QUIT:  # detect attempted exit
                 pygame.quit()
@@ -348,7 +597,7 @@ def create_arg_parser():
 
     parser.add_argument(
         "--renderer",
-        choices=["pygame", "simulation", "replay"],
+        choices=["pygame", "simulation", "replay", "mosaic"],
         default="pygame",
         help="Select renderer type",
     )
@@ -377,6 +626,12 @@ def create_arg_parser():
     parser.add_argument(
         "--n-strokes", type=int, default=5, help="Number of strokes for simulation"
     )
+    parser.add_argument(
+        "--prefetch-frames",
+        type=int,
+        default=64,
+        help="Number of frames the mosaic replay decodes ahead of playback",
+    )
 
     return parser
 
@@ -390,13 +645,17 @@ def create_engine(args: argparse.Namespace, sim_index: int = 0) -> Engine:
         num_sims=args.num_sims,
         aircolor=COLOURS[args.aircolor],
         data_path=args.data_path,
-        max_frames=args.max_frames,
+        # The mosaic replay sizes itself from the recordings and should only exit
+        # when the window is closed, so it never stops on a frame count.
+        max_frames=args.max_frames if args.renderer != "mosaic" else -1,
         n_strokes=args.n_strokes,
+        prefetch_frames=args.prefetch_frames,
     )
     renderers = {
         "pygame": PygameRenderer,
         "simulation": SimulationRenderer,
         "replay": ReplayRenderer,
+        "mosaic": MosaicReplayRenderer,
     }
     renderer = renderers[args.renderer](config)
     input_handlers = {
@@ -404,25 +663,39 @@ def create_engine(args: argparse.Namespace, sim_index: int = 0) -> Engine:
         "simulation": SimulationInputHandler,
         "dummy": DummyInputHandler,
     }
-    # In replay mode, no input is accepted.
+    # In replay modes, no input is accepted.
     input_handler = input_handlers[
-        args.input_handler if args.renderer != "replay" else "dummy"
+        args.input_handler if args.renderer not in ("replay", "mosaic") else "dummy"
     ](config)
     return Engine(config, renderer, input_handler)
 
 
+def run_simulation(args: argparse.Namespace, sim_index: int):
+    """Build and run a single simulation inside a pool worker."""
+    args = argparse.Namespace(**vars(args))
+    args.data_path = os.path.join(args.data_path, f"sim_{sim_index}")
+    create_engine(args, sim_index).run()
+
+
 def main():
     parser = create_arg_parser()
     args = parser.parse_args()
-    if args.num_sims > 1:
-        with Pool(os.cpu_count()) as pool:
-            processes = []
-            for sim_index in range(args.num_sims):
-                args.data_path = f"data/sim_{sim_index}"
-                processes.append(pool.apply_async(create_engine(args).run))
-
-            for process in processes:
-                process.get()
+    # The mosaic replay uses --num-sims as the number of recordings to tile.
+    if args.num_sims > 1 and args.renderer != "mosaic":
+        # Where available, workers are forked from a server that has already
+        # imported this module (and NumPy), so each one starts quickly and shares
+        # those pages. Otherwise (e.g. on Windows) use the default start method.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["fs.main"])
+        else:
+            ctx = multiprocessing.get_context()
+        with ctx.Pool(os.cpu_count()) as pool:
+            pool.starmap(
+                run_simulation,
+                [(args, sim_index) for sim_index in range(args.num_sims)],
+                chunksize=1,
+            )
     else:
         create_engine(args).run()
 